@@ -1,14 +1,113 @@
+import os
+import functools
+import types
 import yaml
+import orjson
 import ray
 from ray import serve
+from starlette.responses import Response
 import uuid
+import inspect
 from typing import Type, Any
 
-with open("deployment_config.yml") as stream:
-    try:
-        config = yaml.safe_load(stream)
-    except yaml.YAMLError as exc:
-        print(exc)
+# libyaml-backed loader when PyYAML was built with it
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _freeze(value):
+    """Recursively turn parsed YAML into mappingproxies and tuples so the shared config can't be mutated"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def load_deployment_config(path=os.path.join(os.path.dirname(__file__), "deployment_config.yml")):
+    """Parse the deployment config once per process"""
+    with open(path) as stream:
+        return _freeze(yaml.load(stream, Loader=YamlLoader))
+
+
+config = load_deployment_config()
+
+
+def json_response(payload):
+    """Serialize a response payload with orjson instead of Serve's default json encoder"""
+    return Response(orjson.dumps(payload), media_type="application/json")
+
+
+@ray.remote(num_cpus=0)
+class SharedObjectHolder:
+    """Detached actor owning a model's shared objects so they outlive the script that deployed it"""
+
+    def __init__(self, model_class):
+        # Objects are owned by the worker that puts them, so they're put from inside this actor
+        self._refs = {name: ray.put(obj) for name, obj in model_class.shared_objects().items()}
+
+    def get_refs(self):
+        return self._refs
+
+
+NO_TEXT_ERROR = "No text provided. Use ?text=your_text or send JSON with 'text' field"
+
+
+class ModelDeployment:
+    """Ray Serve replica wrapping a model class that exposes a classify_text method"""
+
+    def __init__(self, model_class, deployment_id, stage, **shared_refs):
+        try:
+            shared = {
+                name: ray.get(ref) if isinstance(ref, ray.ObjectRef) else ref
+                for name, ref in shared_refs.items()
+            }
+        except ray.exceptions.ObjectLostError:
+            # The holder actor is gone, so this replica loads its own copy
+            shared = {}
+        self.model_instance = model_class(**shared)
+        self.deployment_id = deployment_id
+        self.stage = stage
+
+        # Resolve the model's classify_text method once instead of on every request
+        self._classify = getattr(self.model_instance, 'classify_text', None)
+        if self._classify is None:
+            raise ValueError("Model class must have a 'classify_text' method")
+        # Batched models expose classify_text as a coroutine
+        self._classify_is_async = inspect.iscoroutinefunction(self._classify)
+
+    async def __call__(self, request):
+        """Handle HTTP requests"""
+        # Get text from request
+        if request.method == "GET":
+            # Query parameter approach
+            text = request.query_params.get("text", "")
+        else:
+            # JSON body approach, an empty or malformed body is treated as no text
+            body = await request.body()
+            try:
+                data = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                data = None
+            text = data.get("text", "") if isinstance(data, dict) else ""
+
+        if not text:
+            return json_response({"error": NO_TEXT_ERROR})
+
+        try:
+            if self._classify_is_async:
+                result = await self._classify(text)
+            else:
+                result = self._classify(text)
+        except Exception as e:
+            return json_response({"error": f"Prediction failed: {str(e)}"})
+
+        return json_response({
+            "text": text,
+            "predicted_label": result,
+            "deployment_id": self.deployment_id,
+            "stage": self.stage
+        })
 
 
 class RayDeployment:
@@ -21,15 +120,35 @@ class RayDeployment:
             stage: Deployment stage (development, testing, production)
         """
         if stage not in config["allowed_stages"]:
-            raise ValueError(f'Stage {stage} not allowed, allowed stages are {config["allowed_stages"]}')
+            raise ValueError(f'Stage {stage} not allowed, allowed stages are {list(config["allowed_stages"])}')
         
         self.model_class = model_class
         self.stage = stage
         self.deployment_decorator = deployment_decorator
         self.deployment_id = str(uuid.uuid4())[:8]  # Generate unique ID
         self.deployment_name = f"{model_class.__name__}_{self.deployment_id}"
+        # Detached actor owning the model's shared objects, kept so teardown can release them
+        self.shared_object_holder = None
+
+    def _shared_init_kwargs(self):
+        """Load the model's shared objects into the object store once per deployment"""
+        if not hasattr(self.model_class, "shared_objects"):
+            return {}
+        if self.shared_object_holder is None:
+            # Named after the deployment, so redeploying it reuses the holder created the first time
+            self.shared_object_holder = SharedObjectHolder.options(
+                name=f"{self.deployment_name}_shared_objects",
+                lifetime="detached",
+                get_if_exists=True
+            ).remote(self.model_class)
+        return ray.get(self.shared_object_holder.get_refs.remote())
+
+    def release_shared_objects(self):
+        """Kill the holder actor, which frees the shared objects it owns"""
+        if self.shared_object_holder is not None:
+            ray.kill(self.shared_object_holder)
+            self.shared_object_holder = None
 
-        
     def deploy_model(self):
         """Deploy the model using Ray Serve"""
         if not ray.is_initialized():
@@ -37,6 +156,14 @@ class RayDeployment:
         
         # Start Ray Serve
         serve.start(detached=True)
+
+        # Models exposing shared_objects() load them once into Ray's shared-memory object store,
+        # replicas then read them from there instead of each loading their own copy
+        init_kwargs = self._shared_init_kwargs()
+
+        # Pin OpenMP/MKL threads to each replica's CPU share so replicas don't oversubscribe cores
+        num_threads = str(max(1, int(config["default_resources"]["num_cpus"])))
+        runtime_env = {"env_vars": {"OMP_NUM_THREADS": num_threads, "OMP_WAIT_POLICY": "ACTIVE"}}
         
         # Create Ray Serve ray_wrapper decorator with appropriate settings
         if self.deployment_decorator is not None:
@@ -48,7 +175,8 @@ class RayDeployment:
                 ray_actor_options={
                     "num_cpus": config["default_resources"]["num_cpus"],
                     "num_gpus": config["default_resources"]["num_gpus"],
-                    "memory": config["default_resources"]["memory"]
+                    "memory": config["default_resources"]["memory"],
+                    "runtime_env": runtime_env
                 },
                 health_check_timeout_s=config["production_settings"]["health_check_timeout_s"],
                 graceful_shutdown_wait_loop_s=config["production_settings"]["graceful_shutdown_wait_loop_s"]
@@ -61,50 +189,14 @@ class RayDeployment:
                 ray_actor_options={
                     "num_cpus": config["default_resources"]["num_cpus"],
                     "num_gpus": config["default_resources"]["num_gpus"],
-                    "memory": config["default_resources"]["memory"]
+                    "memory": config["default_resources"]["memory"],
+                    "runtime_env": runtime_env
                 }
             )
         
-        # Create the ray_wrapper class
-        @deployment_decorator
-        class ModelDeployment:
-            def __init__(self):
-                self.model_instance = self.model_class()
-            
-            async def __call__(self, request):
-                """Handle HTTP requests"""
-                try:
-                    # Get text from request
-                    if hasattr(request, 'query_params'):
-                        # Query parameter approach
-                        text = request.query_params.get("text", "")
-                    else:
-                        # JSON body approach
-                        import json
-                        body = await request.body()
-                        data = json.loads(body)
-                        text = data.get("text", "")
-                    
-                    if not text:
-                        return {"error": "No text provided. Use ?text=your_text or send JSON with 'text' field"}
-                    
-                    # Use the model's classify_text method
-                    if hasattr(self.model_instance, 'classify_text'):
-                        result = self.model_instance.classify_text(text)
-                        return {
-                            "text": text,
-                            "predicted_label": result,
-                            "deployment_id": self.deployment_id,
-                            "stage": self.stage
-                        }
-                    else:
-                        return {"error": "Model class must have a 'classify_text' method"}
-                        
-                except Exception as e:
-                    return {"error": f"Prediction failed: {str(e)}"}
-        
         # Deploy the model
-        ModelDeployment.deploy()
+        deployment = deployment_decorator(ModelDeployment)
+        deployment.deploy(self.model_class, self.deployment_id, self.stage, **init_kwargs)
         
         print(f"Model deployed successfully!")
         print(f"Deployment ID: {self.deployment_id}")
@@ -118,3 +210,9 @@ class RayDeployment:
             "endpoint": f"http://localhost:8000/{self.deployment_name}",
             "stage": self.stage
         }
+
+    def delete_model(self):
+        """Delete the deployment and the shared objects its replicas were built from"""
+        serve.get_deployment(self.deployment_name).delete()
+        self.release_shared_objects()
+        print(f"Deployment {self.deployment_name} deleted")
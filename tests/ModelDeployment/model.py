@@ -1,28 +1,345 @@
+import os
+import functools
+import tempfile
 import torch
 from transformers import DistilBertForSequenceClassification, AutoTokenizer
+from ray import serve
+from typing import List
 import yaml
 
-with open('config.yml', 'r') as stream:
-    try:
-        config = yaml.safe_load(stream)
-    except yaml.YAMLError as exc:
-        print(exc)
+with open(os.path.join(os.path.dirname(__file__), 'config_testing_model.yml'), 'r') as stream:
+    config = yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
 tokenizer = config['tokenizer']
 model = config['model']
+max_length = config.get('max_length', 128)
+precision = config.get('precision', 'fp32')
+ipex_optimize = config.get('ipex_optimize', False)
+quantization = config.get('quantization')
+quantized_model_path = config.get('quantized_model_path', 'distilbert_int8.pt')
+backend = config.get('backend', 'torch')
+onnx_model_path = config.get('onnx_model_path', 'distilbert.onnx')
+tokenizer_cache_size = config.get('tokenizer_cache_size', 4096)
+length_buckets = config.get('length_buckets', [64])
+better_transformer = config.get('better_transformer', False)
+cuda_graph = config.get('cuda_graph', False)
+
+MAX_BATCH_SIZE = 16
+
+# One intra-op pool sized to the replica's CPU share, no inter-op pool competing with it.
+# Both settings are process-wide, so they're applied once at import rather than per instance
+torch.set_num_threads(int(os.environ.get("OMP_NUM_THREADS", torch.get_num_threads())))
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    # The inter-op pool can only be sized before the process first uses it
+    pass
+
+
+def artifact_path(filename):
+    """Resolve a cached model artifact next to this module, keyed on the configured model"""
+    root, ext = os.path.splitext(filename)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{root}-{model.replace('/', '--')}{ext}")
+
+
+def save_atomically(path, save):
+    """Write an artifact through a temporary file so concurrent replicas never load a partial one"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        save(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Representative reviews used to calibrate the INT8 activation ranges
+CALIBRATION_REVIEWS = [
+    "Great service, the staff was friendly and the food arrived quickly.",
+    "Terrible experience. The order was wrong and nobody apologized.",
+    "It was okay, nothing special but I would probably come back.",
+    "Absolutely loved it! Best purchase I have made this year.",
+    "The product broke after two days and customer support never answered my emails, "
+    "so I had to return it and wait three weeks for the refund.",
+    "Not worth the price.",
+]
 
 class ReviewClassifier:
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
-        self.model = DistilBertForSequenceClassification.from_pretrained(model, ignore_mismatched_sizes=True)
+    def __init__(self, model_config=None, weights=None, buffers=None, pretrained_tokenizer=None):
+        # ONNX Runtime is served through its CPU execution provider
+        self.device = torch.device('cuda' if torch.cuda.is_available() and backend != "onnx" else 'cpu')
+        use_cuda = self.device.type == 'cuda'
+
+        if pretrained_tokenizer is None:
+            pretrained_tokenizer = AutoTokenizer.from_pretrained(tokenizer, use_fast=True)
+        self.tokenizer = pretrained_tokenizer
+        # Repeated reviews skip tokenization entirely
+        self._token_ids = functools.lru_cache(maxsize=tokenizer_cache_size)(self._tokenize)
+        # Batches are assembled in place instead of allocating fresh tensors per request,
+        # pinned so host to device copies can run asynchronously
+        self._input_ids = torch.empty(MAX_BATCH_SIZE * max_length, dtype=torch.long, pin_memory=use_cuda)
+        self._attention_mask = torch.empty(MAX_BATCH_SIZE * max_length, dtype=torch.long, pin_memory=use_cuda)
+        if weights is None:
+            self.model = DistilBertForSequenceClassification.from_pretrained(model, ignore_mismatched_sizes=True)
+        else:
+            # Built on the meta device so no parameters are allocated or randomly initialised, assign=True
+            # then makes them alias the object store's read-only arrays instead of copying them.
+            # CPU parameters must therefore never be written in place, only replaced
+            with torch.device("meta"):
+                self.model = DistilBertForSequenceClassification(model_config)
+            self.model.load_state_dict({name: torch.from_numpy(array) for name, array in weights.items()}, assign=True)
+            for name, array in buffers.items():
+                module_name, _, buffer_name = name.rpartition('.')
+                setattr(self.model.get_submodule(module_name), buffer_name, torch.from_numpy(array))
+        self.model.eval()
+        # Plain list so a batch of class ids maps to labels by indexing
+        self.labels = [self.model.config.id2label[i] for i in range(self.model.config.num_labels)]
+
+        if backend not in ("torch", "torchscript", "onnx"):
+            raise ValueError(f'Backend {backend} not supported, supported backends are "torch", "torchscript" and "onnx"')
+        if precision not in ("fp32", "bf16"):
+            raise ValueError(f'Precision {precision} not supported, supported precisions are "fp32" and "bf16"')
+        if quantization not in (None, "int8"):
+            raise ValueError(f'Quantization {quantization} not supported, supported quantization is "int8"')
+        self.bf16 = False
+        self.session = None
+        self.graphs = {}
+
+        self.length_buckets = sorted({edge for edge in length_buckets if edge < max_length} | {max_length})
+
+        # Traced modules are specialised to the shape they were traced with
+        self.pad_to_max_length = False
+        if backend == "onnx":
+            # ONNX Runtime applies its own graph optimizations to the FP32 export
+            self.session = self._load_onnx_session()
+        elif quantization == "int8" and not use_cuda:
+            self.pad_to_max_length = True
+            self.model = self._load_int8_model()
+        else:
+            if use_cuda:
+                # IPEX precision and quantization target CPUs, GPU replicas run FP16 on tensor cores instead
+                self.model = self.model.to(self.device).half()
+            if better_transformer:
+                # BetterTransformer's fastpath now lives in transformers itself as fused SDPA attention
+                self.model.set_attn_implementation("sdpa")
+            if (ipex_optimize or precision == "bf16") and not use_cuda:
+                # Prepacks the Linear weights into oneDNN's blocked layout, the torchscript
+                # backend then bakes that layout into the frozen graph
+                import intel_extension_for_pytorch as ipex
+                self.bf16 = precision == "bf16"
+                self.model = ipex.optimize(self.model, dtype=torch.bfloat16 if self.bf16 else torch.float32,
+                                           level='O1', weights_prepack=True, auto_kernel_selection=True)
+            # Frozen modules expose no parameters, so the graphs' mask dtype is read before tracing
+            self.dtype = next(self.model.parameters()).dtype
+            if backend == "torchscript":
+                self.pad_to_max_length = True
+                # Graphs replay the traced module, so it's traced with the mask format they pass it
+                self.model = self._trace(self.model, additive_mask=cuda_graph and use_cuda)
+            if cuda_graph and use_cuda:
+                self.graphs = self._capture_cuda_graphs()
+
+    @classmethod
+    def shared_objects(cls):
+        """Load the tokenizer and weights once so RayDeployment can share them across replicas"""
+        pretrained = DistilBertForSequenceClassification.from_pretrained(model, ignore_mismatched_sizes=True)
+        return {
+            "model_config": pretrained.config,
+            **cls.shareable_tensors(pretrained),
+            "pretrained_tokenizer": AutoTokenizer.from_pretrained(tokenizer, use_fast=True)
+        }
+
+    @staticmethod
+    def shareable_tensors(module):
+        """Split a module's tensors into its state dict and the non-persistent buffers the state dict leaves out"""
+        # numpy arrays are stored zero-copy, so replicas on a node map the same weights
+        weights = {name: tensor.numpy() for name, tensor in module.state_dict().items()}
+        buffers = {name: tensor.numpy() for name, tensor in module.named_buffers() if name not in weights}
+        return {"weights": weights, "buffers": buffers}
+
+    def _tokenize(self, text):
+        encoded = self.tokenizer(text, truncation=True, max_length=max_length, return_tensors='np')
+        return encoded['input_ids'][0]
+
+    def _bucket(self, token_ids):
+        """Group batch rows by length bucket so short reviews aren't padded to the longest one"""
+        if self.pad_to_max_length:
+            return [range(len(token_ids))]
+
+        buckets = {}
+        for row, ids in enumerate(token_ids):
+            edge = next(edge for edge in self.length_buckets if len(ids) <= edge)
+            buckets.setdefault(edge, []).append(row)
+        return buckets.values()
+
+    def _encode(self, token_ids):
+        seq_len = max_length if self.pad_to_max_length else max(len(ids) for ids in token_ids)
+
+        # Contiguous views over the front of the shared buffers
+        size = len(token_ids) * seq_len
+        input_ids = self._input_ids[:size].view(len(token_ids), seq_len)
+        attention_mask = self._attention_mask[:size].view(len(token_ids), seq_len)
+        input_ids.fill_(self.tokenizer.pad_token_id)
+        attention_mask.zero_()
+        for row, ids in enumerate(token_ids):
+            input_ids[row, :len(ids)] = torch.from_numpy(ids)
+            attention_mask[row, :len(ids)] = 1
+
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+    def _forward(self, encoded_input):
+        if self.session is not None:
+            return self.session.run(None, {name: tensor.numpy() for name, tensor in encoded_input.items()})[0]
+
+        input_ids = encoded_input['input_ids'].to(self.device, non_blocking=True)
+        attention_mask = encoded_input['attention_mask'].to(self.device, non_blocking=True)
+
+        if self.graphs:
+            return self._replay_cuda_graph(input_ids, attention_mask)
 
-    def classify_text(self, text):
-        encoded_input = self.tokenizer(text, return_tensors='pt')
+        # Positional call so the same code path works for eager and traced modules
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=self.bf16):
+            return self.model(input_ids, attention_mask)['logits']
 
+    def _capture_cuda_graphs(self):
+        """Capture the forward pass as one CUDA graph per length bucket at the full batch size"""
+        graphs = {}
+        pool = None
+        for edge in [max_length] if self.pad_to_max_length else self.length_buckets:
+            static_ids = torch.full((MAX_BATCH_SIZE, edge), self.tokenizer.pad_token_id, dtype=torch.long, device=self.device)
+            # Warm up and capture with padding present, as in the batches the graph will replay
+            static_mask = torch.ones((MAX_BATCH_SIZE, edge), dtype=torch.long, device=self.device)
+            static_mask[:, edge // 2:] = 0
+
+            with torch.no_grad():
+                # Warm up on a side stream so lazy initialisation isn't captured
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    for _ in range(3):
+                        self._graph_forward(static_ids, static_mask)
+                torch.cuda.current_stream().wait_stream(stream)
+
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph, pool=pool):
+                    static_logits = self._graph_forward(static_ids, static_mask)
+
+            # Buckets are replayed one at a time, so their graphs can share a memory pool
+            pool = graph.pool()
+            graphs[edge] = (graph, static_ids, static_mask, static_logits)
+        return graphs
+
+    def _graph_forward(self, input_ids, attention_mask):
+        """Forward pass without data-dependent branches, safe to capture in a CUDA graph"""
+        return self.model(input_ids, self._additive_mask(attention_mask))['logits']
+
+    def _additive_mask(self, attention_mask):
+        # transformers uses a prepared 4D mask as-is, skipping its "mask has no padding" check
+        return (1.0 - attention_mask[:, None, None, :].to(self.dtype)) * torch.finfo(self.dtype).min
+
+    def _replay_cuda_graph(self, input_ids, attention_mask):
+        batch_size, seq_len = input_ids.shape
+        edge = next(edge for edge in self.length_buckets if seq_len <= edge)
+        graph, static_ids, static_mask, static_logits = self.graphs[edge]
+
+        # Positions past the copied inputs are masked out, stale ids there don't matter
+        static_mask.zero_()
+        static_ids[:batch_size, :seq_len].copy_(input_ids, non_blocking=True)
+        static_mask[:batch_size, :seq_len].copy_(attention_mask, non_blocking=True)
+        graph.replay()
+
+        return static_logits[:batch_size]
+
+    def _example_inputs(self):
+        # Encoded like the batches the traced module will run on, padded to max_length
+        example = self._encode([self._token_ids("dummy text")])
+        return example['input_ids'].to(self.device), example['attention_mask'].to(self.device)
+
+    def _trace(self, module, additive_mask=False):
+        """Trace and freeze a module so TorchScript can fuse its operators"""
+        input_ids, attention_mask = self._example_inputs()
+        if additive_mask:
+            attention_mask = self._additive_mask(attention_mask)
+        with torch.no_grad(), torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=self.bf16):
+            traced = torch.jit.trace(module, (input_ids, attention_mask), strict=False)
+            return torch.jit.freeze(traced)
+
+    def _load_int8_model(self):
+        """Statically quantize the model to INT8 with IPEX, reusing a saved TorchScript module if present"""
+        path = artifact_path(quantized_model_path)
+        if os.path.exists(path):
+            return torch.jit.load(path)
+
+        import intel_extension_for_pytorch as ipex
+        from intel_extension_for_pytorch.quantization import prepare, convert
+
+        prepared = prepare(self.model, ipex.quantization.default_static_qconfig_mapping,
+                           example_inputs=self._example_inputs(), inplace=False)
         with torch.no_grad():
-            logits = self.model(**encoded_input).logits
+            for review in CALIBRATION_REVIEWS:
+                calibration_input = self.tokenizer(review, return_tensors='pt', padding='max_length',
+                                                   truncation=True, max_length=max_length)
+                prepared(calibration_input['input_ids'], calibration_input['attention_mask'])
+
+        traced = self._trace(convert(prepared))
+        save_atomically(path, traced.save)
+        return traced
+
+    def _load_onnx_session(self):
+        """Export the model to ONNX if needed and open an ONNX Runtime session on it"""
+        path = artifact_path(onnx_model_path)
+        if not os.path.exists(path):
+            example = self._encode([self._token_ids("dummy text")])
+
+            def export(tmp_path):
+                with torch.no_grad():
+                    torch.onnx.export(
+                        self.model,
+                        (example['input_ids'], example['attention_mask']),
+                        tmp_path,
+                        input_names=['input_ids', 'attention_mask'],
+                        output_names=['logits'],
+                        dynamic_axes={
+                            'input_ids': {0: 'batch', 1: 'sequence'},
+                            'attention_mask': {0: 'batch', 1: 'sequence'},
+                            'logits': {0: 'batch'}
+                        },
+                        opset_version=17,
+                        # A single file, so the atomic rename can't separate the weights from the graph
+                        external_data=False
+                    )
+
+            save_atomically(path, export)
+
+        import onnxruntime
+
+        # ONNX Runtime runs its own thread pool rather than OpenMP, so it's sized here
+        # to the same per-replica CPU share as torch's intra-op pool
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    async def classify_text(self, text):
+        # Concurrent calls are coalesced by handle_batch into a single forward pass
+        return await self.handle_batch(text)
+
+    @serve.batch(max_batch_size=MAX_BATCH_SIZE, batch_wait_timeout_s=0.01)
+    async def handle_batch(self, texts: List[str]) -> List[str]:
+        return self._classify_batch(texts)
+
+    def _classify_batch(self, texts):
+        token_ids = [self._token_ids(text) for text in texts]
+
+        # Attention cost grows with the padded length, so each bucket gets its own forward pass
+        predicted_class_ids = [None] * len(texts)
+        for rows in self._bucket(token_ids):
+            encoded_input = self._encode([token_ids[row] for row in rows])
+
+            with torch.inference_mode():
+                logits = self._forward(encoded_input)
 
-        predicted_class_id = logits.argmax().item()
-        predicted_label = self.model.config.id2label[predicted_class_id]
+            for row, class_id in zip(rows, logits.argmax(-1).tolist()):
+                predicted_class_ids[row] = class_id
 
-        return predicted_label
+        return [self.labels[class_id] for class_id in predicted_class_ids]
@@ -0,0 +1,88 @@
+"""
+Tests for the HTTP dispatch of ModelDeployment.
+Replicas are instantiated directly with stub models, so no Ray cluster is needed.
+"""
+
+import asyncio
+import sys
+import os
+
+import orjson
+import pytest
+from starlette.requests import Request
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from ray_wrapper.ray_wrapper import ModelDeployment, NO_TEXT_ERROR
+
+
+class EchoClassifier:
+    def classify_text(self, text):
+        return f"label for {text}"
+
+
+class AsyncEchoClassifier:
+    async def classify_text(self, text):
+        return f"async label for {text}"
+
+
+class FailingClassifier:
+    def classify_text(self, text):
+        raise RuntimeError("model exploded")
+
+
+def make_request(method, query_string=b"", body=b""):
+    scope = {"type": "http", "method": method, "path": "/", "query_string": query_string, "headers": []}
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request(scope, receive)
+
+
+def call(deployment, request):
+    response = asyncio.run(deployment(request))
+    return orjson.loads(response.body)
+
+
+def make_deployment(model_class=EchoClassifier):
+    return ModelDeployment(model_class, "abc123", "testing")
+
+
+def test_get_reads_query_parameter():
+    result = call(make_deployment(), make_request("GET", query_string=b"text=Great%20service"))
+
+    assert result == {
+        "text": "Great service",
+        "predicted_label": "label for Great service",
+        "deployment_id": "abc123",
+        "stage": "testing"
+    }
+
+
+def test_post_reads_json_body():
+    result = call(make_deployment(AsyncEchoClassifier), make_request("POST", body=b'{"text": "Slow delivery"}'))
+
+    assert result["predicted_label"] == "async label for Slow delivery"
+
+
+@pytest.mark.parametrize("body", [b"", b"not json", b'["a list"]', b'{"other": "field"}'])
+def test_post_without_text_returns_usage_message(body):
+    result = call(make_deployment(), make_request("POST", query_string=b"text=ignored", body=body))
+
+    assert result == {"error": NO_TEXT_ERROR}
+
+
+def test_get_without_text_returns_usage_message():
+    assert call(make_deployment(), make_request("GET")) == {"error": NO_TEXT_ERROR}
+
+
+def test_prediction_errors_are_reported():
+    result = call(make_deployment(FailingClassifier), make_request("GET", query_string=b"text=hello"))
+
+    assert result == {"error": "Prediction failed: model exploded"}
+
+
+def test_model_without_classify_text_is_rejected():
+    with pytest.raises(ValueError):
+        ModelDeployment(object, "abc123", "testing")
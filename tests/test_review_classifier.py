@@ -0,0 +1,225 @@
+"""
+Tests for the batching logic of ReviewClassifier.
+A stub tokenizer and a tiny randomly initialised DistilBERT stand in for the pretrained ones,
+so no weights are downloaded and no Ray cluster is needed.
+"""
+
+import sys
+import os
+
+import numpy as np
+import pytest
+import torch
+from transformers import DistilBertConfig, DistilBertForSequenceClassification
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'ModelDeployment'))
+
+import model
+from model import ReviewClassifier, max_length
+
+
+class StubTokenizer:
+    """Maps every word to one token id, wrapped in CLS/SEP like the real tokenizer"""
+    pad_token_id = 0
+
+    def __call__(self, text, truncation=False, max_length=None, return_tensors=None, **kwargs):
+        ids = [1] + [2 + len(word) % 50 for word in text.split()] + [3]
+        if truncation and len(ids) > max_length:
+            ids = ids[:max_length - 1] + [3]
+        return {'input_ids': np.array([ids], dtype=np.int64)}
+
+
+class LengthModel:
+    """Predicts each row's unpadded token count as its class id and records the padded shapes it ran on"""
+
+    def __init__(self):
+        self.shapes = []
+
+    def __call__(self, input_ids, attention_mask):
+        self.shapes.append(tuple(input_ids.shape))
+        logits = torch.zeros((input_ids.shape[0], max_length + 1))
+        logits[torch.arange(input_ids.shape[0]), attention_mask.sum(-1)] = 1
+        return {'logits': logits}
+
+
+def make_classifier(stub_model=True):
+    model_config = DistilBertConfig(vocab_size=64, dim=32, n_layers=1, n_heads=2, hidden_dim=64)
+    tensors = ReviewClassifier.shareable_tensors(DistilBertForSequenceClassification(model_config))
+    classifier = ReviewClassifier(model_config=model_config, pretrained_tokenizer=StubTokenizer(), **tensors)
+    if stub_model:
+        classifier.model = LengthModel()
+        classifier.labels = list(range(max_length + 1))
+    return classifier
+
+
+def review(num_words):
+    return " ".join(["word"] * num_words)
+
+
+def test_mixed_lengths_keep_their_order():
+    """Short and long reviews run in separate buckets but come back in request order"""
+    classifier = make_classifier()
+    texts = [review(3), review(80), review(5), review(100)]
+
+    assert classifier._classify_batch(texts) == [5, 82, 7, 102]
+    # Each bucket is padded only to its own longest review
+    assert sorted(classifier.model.shapes) == [(2, 7), (2, 102)]
+
+
+def test_truncated_review_lands_in_last_bucket():
+    """Reviews longer than max_length are truncated and padded together with the other long ones"""
+    classifier = make_classifier()
+    texts = [review(300), review(2), review(70)]
+
+    assert classifier._classify_batch(texts) == [max_length, 4, 72]
+    assert sorted(classifier.model.shapes) == [(1, 4), (2, max_length)]
+
+
+def test_pad_to_max_length_uses_single_bucket():
+    """Traced backends run the whole batch at the shape they were traced with"""
+    classifier = make_classifier()
+    classifier.pad_to_max_length = True
+    texts = [review(3), review(80), review(5)]
+
+    assert classifier._classify_batch(texts) == [5, 82, 7]
+    assert classifier.model.shapes == [(3, max_length)]
+
+
+def test_padding_does_not_change_logits():
+    """A review padded inside a bucket gets the same logits as when it runs on its own"""
+    classifier = make_classifier(stub_model=False)
+    token_ids = [classifier._token_ids(review(3)), classifier._token_ids(review(20))]
+
+    with torch.inference_mode():
+        batched = classifier._forward(classifier._encode(token_ids)).clone()
+        single = classifier._forward(classifier._encode(token_ids[:1]))
+
+    torch.testing.assert_close(batched[0], single[0])
+
+
+def test_graph_forward_matches_eager_on_padded_batch():
+    """The mask path captured in CUDA graphs gives the same logits as the regular forward pass"""
+    classifier = make_classifier(stub_model=False)
+    assert classifier.model.config._attn_implementation == "sdpa"
+    encoded_input = classifier._encode([classifier._token_ids(review(3)), classifier._token_ids(review(20))])
+
+    with torch.inference_mode():
+        expected = classifier._forward(encoded_input).clone()
+        logits = classifier._graph_forward(encoded_input['input_ids'], encoded_input['attention_mask'])
+
+    torch.testing.assert_close(logits, expected)
+
+
+def test_traced_graph_forward_matches_eager_on_padded_batch():
+    """A module traced for CUDA graphs takes the 4D mask and gives the eager logits"""
+    classifier = make_classifier(stub_model=False)
+    classifier.pad_to_max_length = True
+    eager = classifier.model
+    classifier.model = classifier._trace(eager, additive_mask=True)
+    assert not list(classifier.model.parameters())
+
+    encoded_input = classifier._encode([classifier._token_ids(review(3)), classifier._token_ids(review(20))])
+    with torch.inference_mode():
+        expected = eager(**encoded_input)['logits']
+        logits = classifier._graph_forward(encoded_input['input_ids'], encoded_input['attention_mask'])
+
+    torch.testing.assert_close(logits, expected)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA graphs need a GPU")
+@pytest.mark.parametrize("backend", ["torch", "torchscript"])
+def test_cuda_graph_replay_matches_eager_on_padded_batch(monkeypatch, backend):
+    """Replaying a captured graph on a padded batch matches the eager forward pass"""
+    model_config = DistilBertConfig(vocab_size=64, dim=32, n_layers=1, n_heads=2, hidden_dim=64)
+    reference = DistilBertForSequenceClassification(model_config).eval()
+    tensors = ReviewClassifier.shareable_tensors(reference)
+    monkeypatch.setattr(model, "cuda_graph", True)
+    monkeypatch.setattr(model, "backend", backend)
+    classifier = ReviewClassifier(model_config=model_config, pretrained_tokenizer=StubTokenizer(), **tensors)
+    assert classifier.graphs
+    encoded_input = classifier._encode([classifier._token_ids(review(3)), classifier._token_ids(review(20))])
+
+    with torch.inference_mode():
+        replayed = classifier._forward(encoded_input).clone()
+        expected = reference.to(classifier.device).half()(
+            **{name: tensor.to(classifier.device) for name, tensor in encoded_input.items()})['logits']
+
+    torch.testing.assert_close(replayed, expected, rtol=1e-3, atol=1e-3)
+
+
+def test_shared_weights_rebuild_the_model():
+    """A replica built from shared tensors matches the module they were taken from"""
+    model_config = DistilBertConfig(vocab_size=64, dim=32, n_layers=1, n_heads=2, hidden_dim=64)
+    reference = DistilBertForSequenceClassification(model_config).eval()
+    classifier = ReviewClassifier(model_config=model_config, pretrained_tokenizer=StubTokenizer(),
+                                  **ReviewClassifier.shareable_tensors(reference))
+    assert not any(tensor.is_meta for tensor in classifier.model.state_dict().values())
+    assert not any(tensor.is_meta for tensor in classifier.model.buffers())
+
+    input_ids = torch.randint(4, 52, (2, 9))
+    with torch.inference_mode():
+        torch.testing.assert_close(classifier.model(input_ids)['logits'], reference(input_ids)['logits'])
+
+
+def test_better_transformer_switches_to_sdpa(monkeypatch):
+    """The fastpath flag runs attention through SDPA without changing the logits"""
+    monkeypatch.setattr(model, "better_transformer", True)
+    model_config = DistilBertConfig(vocab_size=64, dim=32, n_layers=1, n_heads=2, hidden_dim=64)
+    reference = DistilBertForSequenceClassification(model_config).eval()
+    reference.set_attn_implementation("eager")
+    tensors = ReviewClassifier.shareable_tensors(reference)
+    input_ids = torch.randint(4, 52, (2, 9))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[0, 4:] = 0
+    with torch.inference_mode():
+        # Taken before the classifier switches the config the reference shares with it
+        expected = reference(input_ids, attention_mask)['logits']
+
+    classifier = ReviewClassifier(model_config=model_config, pretrained_tokenizer=StubTokenizer(), **tensors)
+    assert classifier.model.config._attn_implementation == "sdpa"
+    with torch.inference_mode():
+        logits = classifier._forward({'input_ids': input_ids, 'attention_mask': attention_mask})
+
+    torch.testing.assert_close(logits, expected)
+
+
+def test_torchscript_backend_matches_eager(monkeypatch):
+    """The traced and frozen module runs every batch at max_length and matches the eager logits"""
+    monkeypatch.setattr(model, "backend", "torchscript")
+    model_config = DistilBertConfig(vocab_size=64, dim=32, n_layers=1, n_heads=2, hidden_dim=64)
+    reference = DistilBertForSequenceClassification(model_config).eval()
+    classifier = ReviewClassifier(model_config=model_config, pretrained_tokenizer=StubTokenizer(),
+                                  **ReviewClassifier.shareable_tensors(reference))
+    assert isinstance(classifier.model, torch.jit.ScriptModule)
+    assert classifier.pad_to_max_length
+
+    token_ids = [classifier._token_ids(review(3)), classifier._token_ids(review(20))]
+    assert list(classifier._bucket(token_ids)) == [range(2)]
+    encoded_input = classifier._encode(token_ids)
+    assert encoded_input['input_ids'].shape == (2, max_length)
+
+    with torch.inference_mode():
+        expected = reference(**encoded_input)['logits']
+        logits = classifier._forward(encoded_input)
+
+    torch.testing.assert_close(logits, expected)
+
+
+def test_onnx_backend_matches_eager_on_padded_batch(monkeypatch, tmp_path):
+    """The exported ONNX Runtime session gives the same logits as the module it was exported from"""
+    monkeypatch.setattr(model, "backend", "onnx")
+    monkeypatch.setattr(model, "onnx_model_path", str(tmp_path / "distilbert.onnx"))
+    model_config = DistilBertConfig(vocab_size=64, dim=32, n_layers=1, n_heads=2, hidden_dim=64)
+    reference = DistilBertForSequenceClassification(model_config).eval()
+    classifier = ReviewClassifier(model_config=model_config, pretrained_tokenizer=StubTokenizer(),
+                                  **ReviewClassifier.shareable_tensors(reference))
+    assert classifier.session is not None
+    # Only the exported model is left next to it, written under its final name
+    assert [path.suffix for path in tmp_path.iterdir()] == [".onnx"]
+
+    encoded_input = classifier._encode([classifier._token_ids(review(3)), classifier._token_ids(review(20))])
+    with torch.inference_mode():
+        expected = reference(**encoded_input)['logits']
+    logits = classifier._forward(encoded_input)
+
+    torch.testing.assert_close(torch.from_numpy(logits), expected, rtol=1e-4, atol=1e-4)
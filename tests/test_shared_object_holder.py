@@ -0,0 +1,67 @@
+"""
+Tests for the lifecycle of the actor holding a deployment's shared objects.
+These start a local single-CPU Ray instance, but not Ray Serve.
+"""
+
+import sys
+import os
+
+import pytest
+import ray
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from ray_wrapper.ray_wrapper import RayDeployment
+
+
+def make_shared_model_class():
+    # Defined in a function so Ray pickles it by value, the holder's worker can't import this module
+    class SharedModel:
+        @classmethod
+        def shared_objects(cls):
+            return {"weights": [1, 2, 3]}
+
+        def classify_text(self, text):
+            return "positive"
+
+    return SharedModel
+
+
+@pytest.fixture(scope="module")
+def local_ray():
+    ray.init(num_cpus=1, include_dashboard=False)
+    yield
+    ray.shutdown()
+
+
+def test_redeploy_reuses_the_holder(local_ray):
+    """Deploying the same RayDeployment again hands out the refs of the holder it already created"""
+    deployment = RayDeployment(make_shared_model_class())
+    refs = deployment._shared_init_kwargs()
+    holder = deployment.shared_object_holder
+
+    assert deployment._shared_init_kwargs() == refs
+    assert deployment.shared_object_holder is holder
+    assert ray.get(refs["weights"]) == [1, 2, 3]
+    deployment.release_shared_objects()
+
+
+def test_release_kills_the_holder(local_ray):
+    """Releasing the shared objects kills the detached holder instead of leaving it on the cluster"""
+    deployment = RayDeployment(make_shared_model_class())
+    deployment._shared_init_kwargs()
+    holder = deployment.shared_object_holder
+
+    deployment.release_shared_objects()
+
+    assert deployment.shared_object_holder is None
+    with pytest.raises(ray.exceptions.RayActorError):
+        ray.get(holder.get_refs.remote())
+
+
+def test_models_without_shared_objects_start_no_holder(local_ray):
+    """Models that load their own weights deploy without a holder actor"""
+    deployment = RayDeployment(type("PlainModel", (), {"classify_text": lambda self, text: "positive"}))
+
+    assert deployment._shared_init_kwargs() == {}
+    assert deployment.shared_object_holder is None